@@ -8,25 +8,79 @@ ITK files handling
 
 
 """
+import atexit
+import io
 import os
 import os.path as op
+import shlex
+import shutil
 import subprocess
+import threading
+from functools import lru_cache
 from mimetypes import guess_type
-from tempfile import TemporaryDirectory
+from tempfile import mkdtemp
 import SimpleITK as sitk
 import numpy as np
 import nibabel as nb
 from nipype import logging
 from nipype.utils.filemanip import fname_presuffix
 from nipype.interfaces.base import (
-    traits, TraitedSpec, BaseInterfaceInputSpec, File, InputMultiPath, OutputMultiPath,
-    InputMultiObject, OutputMultiObject, SimpleInterface)
+    traits, isdefined, TraitedSpec, BaseInterfaceInputSpec, File, InputMultiPath,
+    OutputMultiPath, InputMultiObject, OutputMultiObject, SimpleInterface)
 from nipype.interfaces.ants.resampling import ApplyTransformsInputSpec
 from dipy.core import geometry as geom
 from ..niworkflows.viz.utils import compose_view, plot_acpc
 
 LOGGER = logging.getLogger('nipype.interface')
 
+# Numpy dtype names mapped to the values antsApplyTransforms accepts for
+# --output-data-type
+_ANTS_DTYPES = {
+    'uint8': 'uchar',
+    'int16': 'short',
+    'int32': 'int',
+    'float32': 'float',
+    'float64': 'double',
+}
+
+# Per-process pool of reusable scratch directories, keyed by the directory
+# they were created in, so interfaces that fire many times do not pay
+# mkdir + rmtree on every run
+_SCRATCH_POOL = {}
+_SCRATCH_LOCK = threading.Lock()
+
+
+def acquire_scratch(base_dir):
+    """Pop a reusable scratch directory under ``base_dir``, creating a fresh
+    one only when the pool is empty."""
+    with _SCRATCH_LOCK:
+        pool = _SCRATCH_POOL.setdefault(base_dir, [])
+        if pool:
+            return pool.pop()
+    return mkdtemp(prefix='tmp-', dir=base_dir)
+
+
+def release_scratch(path):
+    """Empty a scratch directory and return it to the pool for reuse."""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+    with _SCRATCH_LOCK:
+        _SCRATCH_POOL.setdefault(op.dirname(path), []).append(path)
+
+
+@atexit.register
+def _purge_scratch_pool():
+    """Delete every pooled scratch directory so none outlives the process."""
+    with _SCRATCH_LOCK:
+        for pool in _SCRATCH_POOL.values():
+            for path in pool:
+                shutil.rmtree(path, ignore_errors=True)
+        _SCRATCH_POOL.clear()
+
 
 class _AffineToRigidInputSpec(BaseInterfaceInputSpec):
     affine_transform = InputMultiObject(File(exists=True, mandatory=True))
@@ -134,89 +188,257 @@ class MultiApplyTransforms(SimpleInterface):
     output_spec = MultiApplyTransformsOutputSpec
 
     def _run_interface(self, runtime):
-        # Get all inputs from the ApplyTransforms object
-        ifargs = self.inputs.get()
-
-        # Extract number of input images and transforms
-        in_files = ifargs.pop('input_image')
+        # Read just the inputs this interface consumes; self.inputs.get()
+        # would materialize and validate every trait only to discard most
+        in_files = self.inputs.input_image
         num_files = len(in_files)
-        transforms = ifargs.pop('transforms')
-        # Get number of parallel jobs
-        num_threads = ifargs.pop('num_threads')
-        save_cmd = ifargs.pop('save_cmd')
-
-        # Remove certain keys
-        for key in ['environ', 'ignore_exception',
-                    'terminal_output', 'output_image']:
-            ifargs.pop(key, None)
+        transforms = self.inputs.transforms
+        num_threads = self.inputs.num_threads
+        save_cmd = self.inputs.save_cmd
+        copy_dtype = self.inputs.copy_dtype
+        reference_image = self.inputs.reference_image
+
+        # Inversion is encoded inside the per-volume transform token, not in
+        # the static template
+        invert_flags = self.inputs.invert_transform_flags
+        if isdefined(invert_flags):
+            if len(invert_flags) != len(transforms):
+                raise ValueError(
+                    'Number of invert_transform_flags (%d) does not match the'
+                    ' number of transforms (%d)' % (len(invert_flags), len(transforms)))
+        else:
+            invert_flags = None
 
-        # Get a temp folder ready
-        tmp_folder = TemporaryDirectory(prefix='tmp-', dir=runtime.cwd)
+        # Forward only the defined arguments ApplyTransforms understands
+        ifargs = {}
+        for key in ('reference_image', 'interpolation', 'interpolation_parameters',
+                    'dimension', 'input_image_type', 'out_postfix', 'default_value',
+                    'float', 'args', 'print_out_composite_warp_file'):
+            value = getattr(self.inputs, key)
+            if isdefined(value):
+                ifargs[key] = value
 
         # In qsiprep the transforms have already been merged
         xfms_list = transforms
         assert len(xfms_list) == num_files
 
+        # Build the antsApplyTransforms argument template once; across volumes
+        # only the input, output and transform tokens change, so there is no
+        # need to re-validate every trait N times
+        from ..niworkflows.interfaces.fixes import FixHeaderApplyTransforms as ApplyTransforms
+        template = ApplyTransforms(
+            input_image=in_files[0], transforms=xfms_list[0], **ifargs)
+        static_args = template._parse_inputs(
+            skip=('input_image', 'output_image', 'transforms'))
+
+        if copy_dtype:
+            # Ask ANTs to write the input dtype in the first place, so no
+            # volume needs a second decode + rewrite afterwards; dtypes ANTs
+            # cannot write keep the post-hoc path in _postprocess
+            in_dtype = nb.load(in_files[0], mmap=True).header.get_data_dtype()
+            ants_dtype = _ANTS_DTYPES.get(in_dtype.name)
+            if ants_dtype is not None:
+                static_args = static_args + ['--output-data-type %s' % ants_dtype]
+                copy_dtype = False
+
         # Inputs are ready to run in parallel
         if num_threads < 1:
             num_threads = None
 
+        # Output names have a fixed structure, so split the first input's
+        # basename once rather than running fname_presuffix per volume
+        fname = op.basename(in_files[0])
+        base = fname.split('.nii')[0]
+        ext = fname[len(base):]
+        out_pattern = op.join(runtime.cwd, base + '_xform-%05d' + ext)
+
+        # Stream the command log while the command lines are assembled, so
+        # the log hits disk before the batch runs and is never re-joined
+        # into one large string
+        cmdfile = None
+        if save_cmd:
+            self._results['log_cmdline'] = os.path.join(runtime.cwd, 'command.txt')
+            cmdfile = open(self._results['log_cmdline'], 'w')
+
+        # Substitute the per-volume tokens into the prebuilt argument
+        # template; every command line is known before anything runs
+        out_files = [None] * num_files
+        cmdlines = [None] * num_files
+        for i, (in_file, in_xfm) in enumerate(zip(in_files, xfms_list)):
+            out_file = out_pattern % i
+            out_files[i] = out_file
+            # No whitespace inside the bracketed token: the command line goes
+            # through shlex.split/sh before reaching ANTs
+            xfm_token = ('--transform [%s,%d]' % (in_xfm, invert_flags[i])
+                         if invert_flags is not None
+                         else '--transform %s' % in_xfm)
+            cmdlines[i] = ' '.join(
+                ['antsApplyTransforms'] + static_args
+                + ['--input %s' % in_file, '--output %s' % out_file, xfm_token])
+            if cmdfile is not None:
+                if i:
+                    cmdfile.write('\n-------\n')
+                cmdfile.write(cmdlines[i])
+
+        if cmdfile is not None:
+            cmdfile.write('\n')
+            cmdfile.close()
+
+        # Cap each child at one ITK thread, as nipype's ANTSCommand environ
+        # did before execution moved to raw subprocesses; parallelism comes
+        # from the fan-out itself
+        env = {**os.environ,
+               'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': '1',
+               'NSLOTS': '1'}
+
+        concurrency = num_threads or os.cpu_count() or 1
         if num_threads == 1:
-            out_files = [_applytfms((
-                in_file, in_xfm, ifargs, i, runtime.cwd))
-                for i, (in_file, in_xfm) in enumerate(zip(in_files, xfms_list))
-            ]
+            for cmdline in cmdlines:
+                proc = subprocess.run(shlex.split(cmdline), env=env,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                if proc.returncode != 0:
+                    raise RuntimeError('Command failed (%d): %s\n%s' % (
+                        proc.returncode, cmdline,
+                        proc.stderr.decode('utf-8', 'replace')))
+        elif concurrency > 8:
+            # With this many slots an event loop schedules the subprocesses
+            # more cheaply than one xargs worker per slot
+            _run_async(cmdlines, concurrency, env)
         else:
-            from concurrent.futures import ThreadPoolExecutor
-            with ThreadPoolExecutor(max_workers=num_threads) as pool:
-                out_files = list(pool.map(_applytfms, [
-                    (in_file, in_xfm, ifargs, i, runtime.cwd)
-                    for i, (in_file, in_xfm) in enumerate(zip(in_files, xfms_list))]
-                ))
-        tmp_folder.cleanup()
+            # Hand the whole batch to xargs: one submission path amortizes
+            # process startup and keeps Python entirely out of the fan-out
+            tmp_folder = acquire_scratch(runtime.cwd)
+            try:
+                cmds_file = op.join(tmp_folder, 'cmds.txt')
+                with open(cmds_file, 'w') as cmds_fh:
+                    cmds_fh.writelines(cmdline + '\n' for cmdline in cmdlines)
+                proc = subprocess.run(
+                    ['xargs', '-a', cmds_file, '-P', str(concurrency),
+                     '-I', '{}', 'sh', '-c', '{}'], env=env,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                if proc.returncode != 0:
+                    # xargs does not say which command failed; the ones that
+                    # left no output are the offenders
+                    missing = [cmdline for cmdline, out_file
+                               in zip(cmdlines, out_files)
+                               if not op.exists(out_file)]
+                    raise RuntimeError(
+                        'xargs batch failed (%d); %d command(s) produced no'
+                        ' output:\n%s\n%s' % (
+                            proc.returncode, len(missing), '\n'.join(missing),
+                            proc.stderr.decode('utf-8', 'replace')))
+            finally:
+                release_scratch(tmp_folder)
+
+        # Fix headers (and dtypes) once the volumes exist
+        for in_file, out_file in zip(in_files, out_files):
+            _postprocess(out_file, in_file, reference_image, copy_dtype)
 
         # Collect output file names, after sorting by index
-        self._results['out_files'] = [el[0] for el in out_files]
-
-        if save_cmd:
-            self._results['log_cmdline'] = os.path.join(runtime.cwd, 'command.txt')
-            with open(self._results['log_cmdline'], 'w') as cmdfile:
-                print('\n-------\n'.join([el[1] for el in out_files]),
-                      file=cmdfile)
+        self._results['out_files'] = out_files
         return runtime
 
 
-def _applytfms(args):
+def _run_async(cmdlines, concurrency, env=None):
+    """
+    Run many command lines as asyncio subprocesses, at most ``concurrency``
+    in flight at a time. One coroutine per command is cheaper than one OS
+    thread (or xargs slot) per command once concurrency reaches the tens.
     """
-    Applies ANTs' antsApplyTransforms to the input image.
-    All inputs are zipped in one tuple to make it digestible by
-    multiprocessing's map
+    import asyncio
+
+    async def _run_one(sem, cmdline):
+        async with sem:
+            proc = await asyncio.create_subprocess_exec(
+                *shlex.split(cmdline), env=env,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE)
+            try:
+                _, err = await proc.communicate()
+            except asyncio.CancelledError:
+                # gather cancels the siblings of a failed task; cancelling
+                # the await does not kill the subprocess, so reap it here
+                # rather than leave it running after the node has failed
+                proc.kill()
+                await proc.wait()
+                raise
+            if proc.returncode != 0:
+                raise RuntimeError('Command failed (%d): %s\n%s' % (
+                    proc.returncode, cmdline, err.decode('utf-8', 'replace')))
+
+    async def _run_all():
+        sem = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*(_run_one(sem, cmdline) for cmdline in cmdlines))
+
+    asyncio.run(_run_all())
+
+
+def _load_nifti_native(path):
+    """Load a NIfTI's array at its on-disk dtype.
+
+    ``np.asarray(img.dataobj)`` reads through the (memory-mapped) array proxy
+    without the float64 upcast ``get_fdata`` performs, halving peak memory for
+    float32 volumes. Any NIfTI handled by this module (resampled volumes,
+    displacement fields from :class:`DisassembleTransform`) should go through
+    this rather than ``get_fdata``.
     """
-    import nibabel as nb
-    from nipype.utils.filemanip import fname_presuffix
-    from ..niworkflows.interfaces.fixes import FixHeaderApplyTransforms as ApplyTransforms
+    img = nb.load(path, mmap=True)
+    return np.asarray(img.dataobj), img.header.get_data_dtype()
 
-    in_file, in_xform, ifargs, index, newpath = args
-    out_file = fname_presuffix(in_file, suffix='_xform-%05d' % index,
-                               newpath=newpath, use_ext=True)
 
-    copy_dtype = ifargs.pop('copy_dtype', False)
-    xfm = ApplyTransforms(
-        input_image=in_file, transforms=in_xform, output_image=out_file, **ifargs)
-    xfm.terminal_output = 'allatonce'
-    xfm.resource_monitor = False
-    runtime = xfm.run().runtime
+def _postprocess(out_file, in_file, reference_image, copy_dtype):
+    """
+    Applies the header fix FixHeaderApplyTransforms would have applied to a
+    resampled volume and, optionally, carries the input dtype over
+    """
+    from ..niworkflows import __version__ as nw_version
+    from ..niworkflows.interfaces.utils import _copyxform
+
+    _copyxform(reference_image, out_file,
+               message='MultiApplyTransforms (niworkflows v%s)' % nw_version)
 
     if copy_dtype:
-        nii = nb.load(out_file)
-        in_dtype = nb.load(in_file).get_data_dtype()
+        # Compare dtypes from the headers alone; get_fdata would decode the
+        # whole array (and upcast to float64) just to answer this question
+        nii = nb.load(out_file, mmap=True)
+        in_dtype = nb.load(in_file, mmap=True).header.get_data_dtype()
 
         # Overwrite only iff dtypes don't match
-        if in_dtype != nii.get_data_dtype():
+        if in_dtype != nii.header.get_data_dtype():
+            data, _ = _load_nifti_native(out_file)
             nii.set_data_dtype(in_dtype)
-            nii.to_filename(out_file)
+            nii.__class__(data, nii.affine, nii.header).to_filename(out_file)
 
-    return (out_file, runtime.cmdline)
+
+@lru_cache(maxsize=256)
+def _read_itk_transform_file(path, mtime):
+    """Cached worker behind :func:`_parse_itk_transform_file`.
+
+    The mtime argument only serves to key the cache so that an edited file
+    is re-read. Returns ``None`` when the file is not an ITK text transform,
+    otherwise the number of transforms, the lines after the header, and a
+    mapping from transform number to its line index.
+    """
+    with open(path) as tf_fh:
+        tfdata = tf_fh.read().strip()
+
+    if not tfdata.startswith('#Insight Transform File'):
+        return None
+
+    # Count number of transforms in ITK transform file, drop the first line
+    nxforms = tfdata.count('#Transform')
+    lines = tuple(tfdata.split('\n')[1:])
+
+    # Index the '#Transform k' markers in a single pass so that looking one
+    # up later does not re-scan the whole file
+    positions = {line[len('#Transform '):]: i for i, line in enumerate(lines)
+                 if line.startswith('#Transform ')}
+    return nxforms, lines, positions
+
+
+def _parse_itk_transform_file(path):
+    """Read and pre-scan an ITK text transform file, caching the result."""
+    return _read_itk_transform_file(path, os.path.getmtime(path))
 
 
 def _arrange_xfms(transforms, num_files, tmp_folder):
@@ -233,19 +455,14 @@ def _arrange_xfms(transforms, num_files, tmp_folder):
             xfms_T.append([tf_file] * num_files)
             continue
 
-        with open(tf_file) as tf_fh:
-            tfdata = tf_fh.read().strip()
+        parsed = _parse_itk_transform_file(tf_file)
 
         # If it is not an ITK transform file, copy to the tfs_matrix directly
-        if not tfdata.startswith('#Insight Transform File'):
+        if parsed is None:
             xfms_T.append([tf_file] * num_files)
             continue
 
-        # Count number of transforms in ITK transform file
-        nxforms = tfdata.count('#Transform')
-
-        # Remove first line
-        tfdata = tfdata.split('\n')[1:]
+        nxforms, tfdata, positions = parsed
 
         # If it is a ITK transform file with only 1 xform, copy to the tfs_matrix directly
         if nxforms == 1:
@@ -262,12 +479,12 @@ def _arrange_xfms(transforms, num_files, tmp_folder):
         # Split combined ITK transforms file
         split_xfms = []
         for xform_i in range(nxforms):
-            # Find start token to extract
-            startidx = tfdata.index('#Transform %d' % xform_i)
-            next_xform = base_xform + tfdata[startidx + 1:startidx + 4] + ['']
+            # Look up the start token from the precomputed index
+            startidx = positions[str(xform_i)]
+            next_xform = base_xform + list(tfdata[startidx + 1:startidx + 4])
             xfm_file = out_base(xform_i)
             with open(xfm_file, 'w') as out_xfm:
-                out_xfm.write('\n'.join(next_xform))
+                out_xfm.writelines(line + '\n' for line in next_xform)
             split_xfms.append(xfm_file)
         xfms_T.append(split_xfms)
 
@@ -277,35 +494,35 @@ def _arrange_xfms(transforms, num_files, tmp_folder):
 
 def disassemble_transform(transform_file, cwd):
     cmd = ['CompositeTransformUtil', '--disassemble', transform_file, 'disassemble']
-    affine_out = cwd + "/00_disassemble_AffineTransform.mat"
-    warp_out = cwd + "/01_disassemble_DisplacementFieldTransform.nii.gz"
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    affine_fname = "00_disassemble_AffineTransform.mat"
+    warp_fname = "01_disassemble_DisplacementFieldTransform.nii.gz"
     LOGGER.info(" ".join(cmd))
-    out, err = proc.communicate()
-    if False in (op.exists(affine_out), op.exists(warp_out)):
+    subprocess.run(cmd, capture_output=True, check=True, text=True)
+    # A single directory listing covers both existence checks
+    entries = {entry.name for entry in os.scandir(cwd)}
+    if not {affine_fname, warp_fname} <= entries:
         raise Exception("unable to unpack composite transform")
-    return [affine_out, warp_out]
+    return [op.join(cwd, affine_fname), op.join(cwd, warp_fname)]
 
 
 def compose_affines(reference_image, affine_list, output_file):
     """Use antsApplyTransforms to get a single affine from multiple affines."""
-    cmd = "antsApplyTransforms -d 3 -r %s -o Linear[%s, 1] " % (
-        reference_image, output_file)
-    cmd += " ".join(["--transform %s" % trf for trf in affine_list])
-    os.system(cmd)
+    cmd = ['antsApplyTransforms', '-d', '3', '-r', reference_image,
+           '-o', 'Linear[%s, 1]' % output_file]
+    cmd += [token for trf in affine_list for token in ('--transform', trf)]
+    LOGGER.info(' '.join(cmd))
+    subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     assert os.path.exists(output_file)
     return output_file
 
 
 def rotation_matrix_from_transform(transform):
     """Get the rotation matrix from an itk transform."""
-    cmd = "antsTransformInfo " + transform
-    proc = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = proc.communicate()
-    result = str(out)
-    if not len(result):
+    result = subprocess.run(['antsTransformInfo', transform],
+                            capture_output=True, check=True, text=True)
+    if not result.stdout:
         raise ValueError("%s returned no transform info" % transform)
-    lines = [line.strip() for line in result.split("\\n")]
+    lines = [line.strip() for line in result.stdout.splitlines()]
     start_lines = [linenum for linenum, contents in enumerate(lines) if contents == "Matrix:"]
     if not len(start_lines):
         raise ValueError("Unable to read rotation matrix from " + transform)
@@ -313,7 +530,18 @@ def rotation_matrix_from_transform(transform):
         raise ValueError("Too many rotation matrices in " + transform)
     start_line = start_lines[0]
     matrix_lines = lines[(start_line+1):(start_line+4)]
-    return np.array([list(map(float, line.split())) for line in matrix_lines])
+    return np.loadtxt(io.StringIO("\n".join(matrix_lines)))
+
+
+def rotation_matrices_from_transforms(transforms):
+    """Get the rotation matrices from many itk transforms at once.
+
+    The antsTransformInfo calls are I/O bound, so they are fanned out over a
+    thread pool rather than run one at a time.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor() as pool:
+        return list(pool.map(rotation_matrix_from_transform, transforms))
 
 
 def itk_affine_to_rigid(transform_file, cwd):